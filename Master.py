@@ -1,17 +1,41 @@
 #!/usr/bin/env python3
-import time
+import asyncio
+import atexit
 import logging
+import logging.handlers
+import os
+import signal
 import sys
-import select
+import socket
+import struct
 import termios
 import tty
+from enum import IntEnum
 from pymodbus.client import ModbusTcpClient
+from pymodbus.exceptions import ModbusException
 
 # Configuration
 HOST = '192.168.137.66'
 PORT = 5020
 SLAVE_ID = 1
 POLL_INTERVAL = 2  # seconds
+COIL_RESYNC_POLLS = 10  # re-read coil state at least this often
+RECONNECT_MAX_BACKOFF = 30  # seconds
+
+# Read HR 0 with Transaction ID 0x0000, sent raw by the [t]est key
+TEST_PDU = b"\x00\x00\x00\x00\x00\x06\x01\x03\x00\x00\x00\x01"
+
+# Raw Read Holding Registers request: MBAP header (transaction id, protocol,
+# length, unit id) followed by function code 3, start address and count
+READ_REQUEST = struct.Struct('>HHHBBHH')
+# Response MBAP header plus function code and byte count
+READ_RESPONSE_HEADER = struct.Struct('>HHHBBB')
+# Register payload decoders indexed by register count
+REGISTERS = (None, struct.Struct('>H'), struct.Struct('>HH'))
+
+# Log labels indexed by coil state
+_ONOFF = ('OFF', 'ON')
+_OPENCLOSED = ('CLOSED', 'OPEN')
 
 # Setup logging to file and console
 log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
@@ -24,16 +48,34 @@ console_handler.setFormatter(log_formatter)
 
 logger = logging.getLogger('TankMaster')
 logger.setLevel(logging.INFO)
-logger.addHandler(file_handler)
+# Batch file writes; records are flushed on WARNING+, when the buffer fills
+# and by logging's own shutdown hook at exit
+logger.addHandler(logging.handlers.MemoryHandler(100, flushLevel=logging.WARNING, target=file_handler))
 logger.addHandler(console_handler)
 
+# Manual override state for the pump and the valve (ON = open for the valve)
+class Override(IntEnum):
+    AUTO = 0
+    OFF = 1
+    ON = 2
+
 # Control flags and overrides
 auto_control = True
-pump_override = None
-valve_override = None
+pump_override = Override.AUTO
+valve_override = Override.AUTO
 exit_flag = False
 skip_next_poll = False
 
+# Transaction id of the last raw read; 0 is left to the test packet
+poll_tid = 0
+
+# Cached coil state: the slave never toggles the coils itself, so they are
+# only re-read after one of our writes or on the periodic resync
+pump_state = False
+valve_state = False
+coils_dirty = True
+polls_since_sync = 0
+
 # Activation A logic
 activation_a_active = False
 activation_a_timer = 0
@@ -46,133 +88,276 @@ tty.setcbreak(fd)
 def restore_terminal():
     termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
 
-# Connect to Modbus slave
+# Restore the terminal on every interpreter exit; SIGTERM exits cleanly
+# instead of killing the process with the terminal left in cbreak mode
+atexit.register(restore_terminal)
+signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+# Modbus slave connection, (re)established by the poll task
 client = ModbusTcpClient(HOST, port=PORT)
-if not client.connect():
-    logger.error(f"Cannot connect to {HOST}:{PORT}")
-    restore_terminal()
-    sys.exit(1)
-logger.info('Connected to Tank Simulator')
 print('Controls: [p]ump, [v]alve, [a]uto, [f]ill, [d]rain, [t]est, [q]uit')
 
-try:
+def show_prompt():
+    sys.stdout.write('\r[p] [v] [a] [f] [d] [t] [q]> ')
+    sys.stdout.flush()
+
+show_prompt()
+
+def connect_slave():
+    client.close()
+    if not client.connect():
+        return False
+    # Small PDUs must not wait on Nagle coalescing
+    client.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return True
+
+async def connect_with_backoff(modbus_lock):
+    backoff = 1
     while not exit_flag:
-        # Display prompt
-        sys.stdout.write('\r[p] [v] [a] [f] [d] [t] [q]> ')
-        sys.stdout.flush()
-
-        # Handle keyboard input
-        if select.select([sys.stdin], [], [], 0)[0]:
-            ch = sys.stdin.read(1).lower()
-            termios.tcflush(fd, termios.TCIFLUSH)
-            if ch == 'q':
-                exit_flag = True
-                logger.info('Exit received')
-            elif ch == 'a':
-                auto_control = not auto_control
-                pump_override = None if auto_control else pump_override
-                logger.info(f"Auto control {'ON' if auto_control else 'OFF'}")
-            elif ch == 'p':
-                auto_control = False
-                pump_override = not pump_override if pump_override is not None else True
-                logger.info(f"Pump override {'ON' if pump_override else 'OFF'}")
-            elif ch == 'v':
-                valve_override = not valve_override if valve_override is not None else True
-                logger.info(f"Valve override {'OPEN' if valve_override else 'CLOSED'}")
-            elif ch == 'f':
-                auto_control = False
-                pump_override = True
-                valve_override = False
-                logger.info('Force FILL: Pump ON, Valve CLOSED')
-            elif ch == 'd':
-                auto_control = False
-                pump_override = False
-                valve_override = True
-                logger.info('Force DRAIN: Pump OFF, Valve OPEN')
-            elif ch == 't':
-                logger.info('Sending Modbus packet with Transaction ID 0x0000 for Suricata PoC')
-                raw_packet = b"\x00\x00\x00\x00\x00\x06\x01\x03\x00\x00\x00\x01"
-                if client.socket:
-                    try:
-                        client.socket.send(raw_packet)
-                        logger.info('Test packet sent.')
-
-                        # Flush leftover response
-                        client.socket.setblocking(0)
-                        try:
-                            while client.socket.recv(1024):
-                                pass
-                        except BlockingIOError:
-                            pass
-                        client.socket.setblocking(1)
-
-                        skip_next_poll = True
-                    except Exception as e:
-                        logger.error(f'Failed to send test packet: {e}')
-                else:
-                    logger.error('No socket connection to send test packet.')
+        async with modbus_lock:
+            connected = await asyncio.to_thread(connect_slave)
+        if connected:
+            logger.info('Connected to Tank Simulator')
+            return True
+        logger.error('Cannot connect to %s:%d, retrying in %ds', HOST, PORT, backoff)
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, RECONNECT_MAX_BACKOFF)
+    return False
 
-        if skip_next_poll:
-            skip_next_poll = False
-            time.sleep(POLL_INTERVAL)
-            continue
+async def modbus_call(func, *args, **kwargs):
+    # Blocking pymodbus calls run in a worker thread; a lost connection
+    # surfaces as None so the poll loop can reconnect
+    try:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    except (ModbusException, OSError) as e:
+        logger.error('Modbus request failed: %s', e)
+        return None
 
-        # Poll sensors
-        rr = client.read_holding_registers(0, count=1, slave=SLAVE_ID)
-        rc = client.read_coils(0, count=2, slave=SLAVE_ID)
-        if not rr or not rc or rr.isError() or rc.isError():
-            logger.error('Read error, exiting')
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed by slave')
+        data += chunk
+    return data
+
+def read_registers(count):
+    # Hot-path poll on the raw socket: unpacking the frame directly skips
+    # building pymodbus response objects; writes still go through pymodbus
+    global poll_tid
+    poll_tid = poll_tid % 0xFFFF + 1
+    sock = client.socket
+    if sock is None:
+        raise ConnectionError('Not connected to slave')
+    # pymodbus's own recv() leaves the socket non-blocking after a write
+    sock.settimeout(client.comm_params.timeout_connect)
+    sock.sendall(READ_REQUEST.pack(poll_tid, 0, 6, SLAVE_ID, 3, 0, count))
+    while True:
+        tid, _, length, _, function, size = READ_RESPONSE_HEADER.unpack(recv_exact(sock, 9))
+        body = recv_exact(sock, length - 3)
+        # Discard stale replies, e.g. the slave's answer to the test packet
+        if tid == poll_tid:
             break
+    if function != 3 or size != 2 * count or len(body) != size:
+        return None
+    return REGISTERS[count].unpack(body)
+
+def send_test_packet():
+    if not client.socket:
+        logger.error('No socket connection to send test packet.')
+        return False
+    try:
+        client.socket.sendall(TEST_PDU)
+        logger.info('Test packet sent.')
 
-        level = rr.registers[0]
+        # Flush leftover response
+        timeout = client.socket.gettimeout()
+        client.socket.settimeout(0)
         try:
-            pump_state, valve_state = rc.bits[0], rc.bits[1]
-        except IndexError:
-            logger.error('Invalid coil response received, exiting')
-            break
+            while client.socket.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        finally:
+            client.socket.settimeout(timeout)
+        return True
+    except Exception as e:
+        logger.error('Failed to send test packet: %s', e)
+        return False
 
-        # Check Activation A condition
-        if not activation_a_active and 500 <= level <= 520:
-            activation_a_active = True
-            activation_a_timer = 5
-            logger.info("Activation A: ACTIVATED")
-
-        if activation_a_active:
-            activation_a_timer -= 1
-            if activation_a_timer <= 0:
-                activation_a_active = False
-                logger.info("Activation A: DEACTIVATED")
-
-        # Decide pump action
-        if pump_override is not None:
-            target_pump = pump_override
-        elif auto_control:
-            if level < 300:
-                target_pump = True
-            elif level > 700:
-                target_pump = False
-            else:
-                target_pump = pump_state
+async def keyboard_task(keys, modbus_lock):
+    global auto_control, pump_override, valve_override, exit_flag, skip_next_poll
+    while not exit_flag:
+        ch = await keys.get()
+        if ch == 'q':
+            exit_flag = True
+            logger.info('Exit received')
+        elif ch == 'a':
+            auto_control = not auto_control
+            pump_override = Override.AUTO if auto_control else pump_override
+            logger.info('Auto control %s', _ONOFF[auto_control])
+        elif ch == 'p':
+            auto_control = False
+            pump_override = Override.OFF if pump_override == Override.ON else Override.ON
+            logger.info('Pump override %s', _ONOFF[pump_override == Override.ON])
+        elif ch == 'v':
+            valve_override = Override.OFF if valve_override == Override.ON else Override.ON
+            logger.info('Valve override %s', _OPENCLOSED[valve_override == Override.ON])
+        elif ch == 'f':
+            auto_control = False
+            pump_override = Override.ON
+            valve_override = Override.OFF
+            logger.info('Force FILL: Pump ON, Valve CLOSED')
+        elif ch == 'd':
+            auto_control = False
+            pump_override = Override.OFF
+            valve_override = Override.ON
+            logger.info('Force DRAIN: Pump OFF, Valve OPEN')
+        elif ch == 't':
+            logger.info('Sending Modbus packet with Transaction ID 0x0000 for Suricata PoC')
+            async with modbus_lock:
+                if await asyncio.to_thread(send_test_packet):
+                    skip_next_poll = True
+        if not exit_flag:
+            show_prompt()
+
+async def wait_next_poll(deadline):
+    # Sleep until the deadline and return the next one, so polls stay on a
+    # fixed POLL_INTERVAL grid; if we fell behind, re-sync from now instead
+    now = asyncio.get_running_loop().time()
+    if deadline <= now:
+        return now + POLL_INTERVAL
+    await asyncio.sleep(deadline - now)
+    return deadline + POLL_INTERVAL
+
+async def poll_once(count):
+    # One read-decide-write cycle; the caller holds modbus_lock throughout so
+    # the test packet cannot land between our read and our coil writes.
+    # Returns False if the read failed.
+    global pump_state, valve_state, coils_dirty, polls_since_sync
+    global activation_a_active, activation_a_timer
+    registers = await modbus_call(read_registers, count)
+    if registers is None:
+        return False
+
+    level = registers[0]
+    if count == 2:
+        bits = registers[1]
+        pump_state, valve_state = bool(bits & 1), bool(bits & 2)
+        coils_dirty = False
+        polls_since_sync = 0
+    else:
+        polls_since_sync += 1
+
+    # Check Activation A condition; the inactive, out-of-range case falls
+    # through both tests
+    if activation_a_active:
+        activation_a_timer -= 1
+        if activation_a_timer <= 0:
+            activation_a_active = False
+            logger.info("Activation A: DEACTIVATED")
+    elif 500 <= level <= 520:
+        activation_a_active = True
+        activation_a_timer = 4  # the activating poll counts as the first of five
+        logger.info("Activation A: ACTIVATED")
+
+    # Decide pump action
+    if pump_override != Override.AUTO:
+        target_pump = pump_override == Override.ON
+    elif auto_control:
+        if level < 300:
+            target_pump = True
+        elif level > 700:
+            target_pump = False
         else:
             target_pump = pump_state
+    else:
+        target_pump = pump_state
 
-        if target_pump != pump_state:
-            client.write_coil(0, target_pump, slave=SLAVE_ID)
-            logger.info(f"Pump set to {'ON' if target_pump else 'OFF'}")
+    # Valve action
+    target_valve = valve_override == Override.ON
+    pump_changed = target_pump != pump_state
+    valve_changed = valve_override != Override.AUTO and target_valve != valve_state
 
-        # Valve action
-        if valve_override is not None and valve_override != valve_state:
-            client.write_coil(1, valve_override, slave=SLAVE_ID)
-            logger.info(f"Valve set to {'OPEN' if valve_override else 'CLOSED'}")
+    # Both coils are adjacent, so a combined change is one Write Multiple Coils
+    if pump_changed and valve_changed:
+        await modbus_call(client.write_coils, 0, [target_pump, target_valve], slave=SLAVE_ID)
+    elif pump_changed:
+        await modbus_call(client.write_coil, 0, target_pump, slave=SLAVE_ID)
+    elif valve_changed:
+        await modbus_call(client.write_coil, 1, target_valve, slave=SLAVE_ID)
 
-        # Log overall state
-        logger.info(f"Level={level} Pump={'ON' if target_pump else 'OFF'} Valve={'OPEN' if valve_state else 'CLOSED'}")
-        time.sleep(POLL_INTERVAL)
+    if pump_changed:
+        coils_dirty = True
+        logger.info('Pump set to %s', _ONOFF[target_pump])
+    if valve_changed:
+        coils_dirty = True
+        logger.info('Valve set to %s', _OPENCLOSED[target_valve])
 
+    # Log overall state
+    logger.info('Level=%d Pump=%s Valve=%s', level, _ONOFF[target_pump], _OPENCLOSED[valve_state])
+    return True
+
+async def poll_task(modbus_lock):
+    global skip_next_poll, coils_dirty
+    if not await connect_with_backoff(modbus_lock):
+        return
+    next_poll = asyncio.get_running_loop().time() + POLL_INTERVAL
+    # Read-failure backoff; only a successful read resets it, so a slave that
+    # accepts connections but never answers does not cause a reconnect storm
+    backoff = 1
+    while not exit_flag:
+        if skip_next_poll:
+            skip_next_poll = False
+            next_poll = await wait_next_poll(next_poll)
+            continue
+
+        # Poll sensors
+        # HR 0 holds the level, HR 1 mirrors the coils (bit0=pump, bit1=valve)
+        count = 2 if coils_dirty or polls_since_sync >= COIL_RESYNC_POLLS else 1
+        async with modbus_lock:
+            polled = await poll_once(count)
+        if not polled:
+            logger.error('Read error, reconnecting in %ds', backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, RECONNECT_MAX_BACKOFF)
+            if not await connect_with_backoff(modbus_lock):
+                break
+            coils_dirty = True
+            continue
+
+        backoff = 1
+        next_poll = await wait_next_poll(next_poll)
+
+async def main():
+    # Keystrokes arrive via the event loop so polling never delays them;
+    # blocking Modbus I/O runs in a worker thread, serialised by modbus_lock
+    loop = asyncio.get_running_loop()
+    keys = asyncio.Queue()
+    modbus_lock = asyncio.Lock()
+
+    def on_key():
+        ch = os.read(fd, 1).decode(errors='ignore').lower()
+        keys.put_nowait(ch)
+
+    loop.add_reader(fd, on_key)
+    tasks = [
+        asyncio.create_task(poll_task(modbus_lock)),
+        asyncio.create_task(keyboard_task(keys, modbus_lock)),
+    ]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        loop.remove_reader(fd)
+        for task in tasks:
+            task.cancel()
+
+try:
+    asyncio.run(main())
 except KeyboardInterrupt:
     logger.info('Interrupted, exiting')
 finally:
     client.close()
-    restore_terminal()
     print()
     logger.info('Master shutdown')
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
-import threading
-import time
+import asyncio
 import logging
-from pymodbus.server import StartTcpServer
-from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext, ModbusSequentialDataBlock
+from array import array
+from pymodbus.server import StartAsyncTcpServer
+from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
+from pymodbus.datastore.store import BaseModbusDataBlock
 from pymodbus.device import ModbusDeviceIdentification
 
 # Configure logging for the slave
@@ -11,13 +12,47 @@ tcore=logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger('TankSlave')
 
+# Sequential datablock backed by a compact array('H') instead of a list of ints
+class ArrayDataBlock(BaseModbusDataBlock):
+    def __init__(self, address, values):
+        self.address = address
+        self.default_value = 0
+        self.values = array('H', values)
+
+    def validate(self, address, count=1):
+        start = address - self.address
+        return start >= 0 and start + count <= len(self.values)
+
+    def getValues(self, address, count=1):
+        start = address - self.address
+        return self.values[start:start + count].tolist()
+
+    def setValues(self, address, values):
+        if not isinstance(values, list):
+            values = [values]
+        start = address - self.address
+        self.values[start:start + len(values)] = array('H', values)
+
+    def reset(self):
+        self.values = array('H', [self.default_value]) * len(self.values)
+
+# Slave context that refreshes the HR 1 coil mirror on every coil write,
+# so the master never reads a mirror that lags its own write
+class TankSlaveContext(ModbusSlaveContext):
+    def setValues(self, fc_as_hex, address, values):
+        super().setValues(fc_as_hex, address, values)
+        if self.decode(fc_as_hex) == 'c':
+            pump_on, valve_open = self.getValues(1, 0, count=2)
+            super().setValues(3, 1, [pump_on | valve_open << 1])
+
 # Initialize data: 20 coils, 20 registers
 # Coil 0: pump (0=off, 1=on), Coil 1: valve (0=closed,1=open)
 # Register 0: water level (0-1000)
-store = ModbusSlaveContext(
+# Register 1: coil mirror (bit0=pump, bit1=valve) so the master can poll one block
+store = TankSlaveContext(
     di=None,
-    co=ModbusSequentialDataBlock(0, [0] * 20),
-    hr=ModbusSequentialDataBlock(0, [500] + [0] * 19),
+    co=ArrayDataBlock(0, [0] * 20),
+    hr=ArrayDataBlock(0, [500] + [0] * 19),
     ir=None
 )
 context = ModbusServerContext(slaves=store, single=True)
@@ -34,39 +69,63 @@ MIN_LEVEL = 0
 PUMP_RATE = 5    # units per second when pump is ON
 DRAIN_RATE = 3   # units per second when valve is OPEN
 
+# Log labels indexed by coil state
+_ONOFF = ('OFF', 'ON')
+_OPENCLOSED = ('CLOSED', 'OPEN')
+
+# Level change per tick, indexed by coil state (bit0=pump, bit1=valve)
+_DELTA = (0, PUMP_RATE, -DRAIN_RATE, PUMP_RATE - DRAIN_RATE)
+
 # Simulation loop: update tank level based on pump/valve state
-def simulate_tank():
+async def simulate_tank():
+    loop = asyncio.get_running_loop()
     last_report = None
+    period = 1.0
+    next_tick = loop.time() + period
     while True:
-        coils = store.getValues(1, 0, count=2)
-        pump_on = bool(coils[0])
-        valve_open = bool(coils[1])
+        pump_on, valve_open = store.getValues(1, 0, count=2)
+        state = pump_on | valve_open << 1
         level = store.getValues(3, 0, count=1)[0]
 
         # Calculate new level
-        delta = (PUMP_RATE if pump_on else 0) - (DRAIN_RATE if valve_open else 0)
-        new_level = max(MIN_LEVEL, min(MAX_LEVEL, level + delta))
-        store.setValues(3, 0, [new_level])
+        new_level = max(MIN_LEVEL, min(MAX_LEVEL, level + _DELTA[state]))
+        store.setValues(3, 0, [new_level, state])
 
         # Log current state
-        logger.info(f"Pump={'ON' if pump_on else 'OFF'} Valve={'OPEN' if valve_open else 'CLOSED'} Level={new_level}")
+        logger.info('Pump=%s Valve=%s Level=%d', _ONOFF[pump_on], _OPENCLOSED[valve_open], new_level)
 
         # Log threshold events once
         if new_level == MIN_LEVEL and last_report != 'empty':
             logger.info("Tank Empty – level = 0")
             last_report = 'empty'
         elif new_level == MAX_LEVEL // 2 and last_report != 'half':
-            logger.info(f"Tank Half Full – level = {new_level}")
+            logger.info('Tank Half Full – level = %d', new_level)
             last_report = 'half'
         elif new_level == MAX_LEVEL and last_report != 'full':
-            logger.info(f"Tank Full – level = {new_level}")
+            logger.info('Tank Full – level = %d', new_level)
             last_report = 'full'
         elif MIN_LEVEL < new_level < MAX_LEVEL:
             last_report = None
 
-        time.sleep(1)
+        # Sleep to the next tick deadline so per-tick work does not accumulate
+        # as drift; re-sync if we fell behind
+        now = loop.time()
+        delay = next_tick - now
+        next_tick += period
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            next_tick = now + period
 
-if __name__ == '__main__':
-    threading.Thread(target=simulate_tank, daemon=True).start()
+# Simulation and Modbus server share one event loop, so no thread touches
+# the datastore concurrently with request handling
+async def main():
+    simulation = asyncio.create_task(simulate_tank())
     logger.info('Starting Tank Simulator on 0.0.0.0:5020')
-    StartTcpServer(context, identity=ident, address=('0.0.0.0', 5020))
+    try:
+        await StartAsyncTcpServer(context, identity=ident, address=('0.0.0.0', 5020))
+    finally:
+        simulation.cancel()
+
+if __name__ == '__main__':
+    asyncio.run(main())